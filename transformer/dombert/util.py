@@ -5,12 +5,23 @@ import torch
 from torch.utils.data import Dataset
 from tqdm import tqdm
 import random
-from collections import defaultdict, deque
+from lm.data import (ExampleMatrix, count_blocks, has_cached_features, load_cached_features, make_examples,
+                     parse_amazon_file, read_review_corpus, save_cached_features, special_tokens, tokenize_file)
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+
+def cached_features_path(file_path, cache_name, block_size):
+    """the features cache of a dataset with `cache_name`, next to the text file."""
+    if cache_name is None:
+        # only the base classes leave it unset.
+        raise NotImplementedError("the dataset class has no cache_name, use one of its subclasses")
+    directory, filename = os.path.split(file_path)
+    return os.path.join(directory, 'cached_' + cache_name + '_' + str(block_size) + '_' + filename + ".npy")
+
+
 def set_seed(args):
     random.seed(args.seed)
     np.random.seed(args.seed)
@@ -21,620 +32,280 @@ def set_seed(args):
 
 
 class TextDataset(Dataset):
-    def __init__(self, model_type, tokenizer, file_path='train', block_size=512):
+    def __init__(self, model_type, tokenizer, file_path='train', block_size=512, direct_io=False, compress_cache=False,
+                 tokenize_workers=None):
         assert os.path.isfile(file_path)
         model_type = model_type.split("-")[0]
         directory, filename = os.path.split(file_path)
         cached_features_file = os.path.join(directory, model_type + '_cached_lm_' + str(block_size) + '_' + filename + ".npy")
 
-        if os.path.exists(cached_features_file):
+        if has_cached_features(cached_features_file):
             logger.info("Loading features from cached file %s", cached_features_file)
-            self.examples = np.load(cached_features_file)
+            self.examples = load_cached_features(cached_features_file, direct_io)
         else:
             logger.info("Creating features from dataset file at %s", directory)
 
-            self.examples = []
-            with open(file_path, encoding="utf-8") as f:
-                buffer = []
-                for line in f:
-                    text = line.strip()
-                    if len(text) > 0:
-                        tokens = tokenizer.tokenize(text)
-                        buffer.extend(tokens)
-                        while len(buffer) >= block_size:
-                            self.examples.append(
-                                np.array(
-                                    [tokenizer.build_inputs_with_special_tokens(tokenizer.convert_tokens_to_ids(buffer[:block_size]))], 
-                                    dtype = np.uint16))
-                            if len(self.examples) % 5000 == 0:
-                                logger.info("Processed %i examples", len(self.examples))
-                            buffer = buffer[block_size:]
-                        
-            self.examples = np.concatenate(self.examples)
-            
+            ids, _ = tokenize_file(tokenizer, file_path, model_type, tokenize_workers)
+            self.examples = make_examples(ids, block_size, *special_tokens(tokenizer))
+            logger.info("Processed %i examples", len(self.examples))
+
             logger.info("Saving features into cached file %s", cached_features_file)
-            np.save(cached_features_file, self.examples)
-        
+            save_cached_features(cached_features_file, self.examples, compress_cache)
+
     def __len__(self):
         return len(self.examples)
 
     def __getitem__(self, item):
+        # widen the uint16 row once into an int64 buffer that torch shares without a copy;
+        # maskers build labels from the inputs, so they have to be long already.
         return torch.from_numpy(self.examples[item].astype(np.int64))
 
             
-class DOIDataset(TextDataset):
-    def __init__(self, model_type, masker, tokenizer, file_path='train', block_size=512):
+class DomainTagDataset(TextDataset):
+    """
+    Base class of the datasets that read the text file with tags and start each block with the embedding index
+    of its domain. Blocks never cross a (domain, rating) boundary; subclasses set `cache_name` and implement
+    `keep` and `domain_seg` to pick the texts and the domain index.
+    `corpus` is the `read_review_corpus` of `file_path`, pass it to share one parse between several datasets
+    (see `load_and_cache_datasets`).
+    """
+    cache_name = None  # the features cache is cached_<cache_name>_<block_size>_<file>.npy, set by every subclass.
+    domain_file = None  # json file of the domain -> embedding index map, next to the text file.
+    dois = None  # Domain of Interests (DOIs), if the dataset has them.
+    group_domains = None  # only build blocks for these domains, in this order (default: all in first-seen order).
+
+    def __init__(self, model_type, masker, tokenizer, file_path='train', block_size=512, direct_io=False, compress_cache=False,
+                 tokenize_workers=None, corpus=None):
         assert os.path.isfile(file_path)
         model_type = model_type.split("-")[0]
-        directory, filename = os.path.split(file_path)
-        cached_features_file = os.path.join(directory, 'cached_doimerged_' + str(block_size) + '_' + filename + ".npy")
+        directory = os.path.dirname(file_path)
+        cached_features_file = cached_features_path(file_path, self.cache_name, block_size)
 
-        if os.path.exists(cached_features_file):
+        if has_cached_features(cached_features_file):
             logger.info("Loading features from cached file %s", cached_features_file)
-            self.examples = np.load(cached_features_file)
+            self.examples = load_cached_features(cached_features_file, direct_io)
         else:
             logger.info("Creating features from dataset file at %s", directory)
 
-            dois = ["Electronics/Computers & Accessories/Laptops", "Restaurants"]
-            
-            logger.info("Domain of Interests (DOIs) %s", str(dois))
-            
-            domain_corpus = defaultdict(lambda: defaultdict(lambda : defaultdict(list)))
-
-            with open(file_path, encoding="utf-8") as f:
-                tag_on = True
-                for line in f:
-                    text = line.strip()
-                    if len(text) == 0:
-                        tag_on = True
-                    elif tag_on:
-                        tag_on = False
-                        segs = text.split()
-                        asin = segs[0]
-                        rating = segs[-1]
-                        domain = "/".join(" ".join(segs[1:-1]).split("/")[:3])
-                    else:
-                        if domain not in dois:
-                            domain_corpus[domain][rating][asin].append(text)
-                                            
-            logger.info("Total number of %d domains", len(domain_corpus))
-            
-            if "train" in file_path:
-                domain_to_id = {"[DOI]": 0}
-                for ix, domain in enumerate(domain_corpus):
-                    if domain not in dois:
-                        domain_to_id[domain]=len(domain_to_id)
-                with open(os.path.join(directory, "doi_domain.json"), "w") as fw:            
+            if self.dois is not None:
+                logger.info("Domain of Interests (DOIs) %s", str(self.dois))
+
+            if corpus is None:
+                corpus = read_review_corpus(file_path)
+            # `keep` masks every text of the file, a selection would pick from (and cap) the wrong texts.
+            assert not corpus.selected, "pass the full read_review_corpus of the file, not a selection"
+            corpus = corpus.select(self.keep(corpus))
+
+            logger.info("Total number of %d domains", len(corpus.domains))
+
+            domain_to_id = self.build_domain_to_id(corpus) if "train" in file_path else None
+            if domain_to_id is not None:
+                with open(os.path.join(directory, self.domain_file), "w") as fw:
                     json.dump(domain_to_id, fw)
             else:
-                with open(os.path.join(directory, "doi_domain.json")) as f:            
+                with open(os.path.join(directory, self.domain_file)) as f:
                     domain_to_id = json.load(f)
 
-            block = [-100] * block_size
-            self.examples = []
-
-            for domain in domain_corpus:
-                logger.info("Processing domain %s", domain)
-
-                for rating in domain_corpus[domain]:
-                    logger.info("| rating %s", rating)
-                    # always use a new buffer for a new domain and rating.
-                    buffer = deque()
-                    for asin in domain_corpus[domain][rating]:
-                        for text in domain_corpus[domain][rating][asin]:
-
-                            tokens = tokenizer.tokenize(text)
-                            buffer.extend(tokens)
-
-                            # need to ensure enough text for short and long before making any example.
-                            while len(buffer) >= block_size:
-                                for ix in range(block_size):
-                                    block[ix] = buffer.popleft()
-                                input_ids = tokenizer.convert_tokens_to_ids(block)
-
-                                if domain in dois:
-                                    domain_seg = [domain_to_id["[DOI]"]]
-                                else:
-                                    domain_seg = [domain_to_id[domain]]
-                                input_ids = domain_seg + tokenizer.build_inputs_with_special_tokens(input_ids)
-
-                                self.examples.append(np.array([input_ids], dtype = np.uint16))
-                                if len(self.examples) % 5000 == 0:
-                                    logger.info("Processed %i examples", len(self.examples))                
-                                    logger.info("one example is like %s", " ".join(tokenizer.convert_ids_to_tokens(input_ids)))
-                        # clean up the memory.
-                        domain_corpus[domain][rating][asin] = []
-
-            self.examples = np.concatenate(self.examples)
+            ids, offsets = tokenize_file(tokenizer, file_path, model_type, tokenize_workers)
+            prefix, suffix = special_tokens(tokenizer)
+            groups = list(corpus.groups(self.group_domains))
+            # every row starts with its domain seg ahead of the tokenizer's prefix.
+            width = 1 + len(prefix) + block_size + len(suffix)
+            self.examples = ExampleMatrix(width, sum(count_blocks(offsets, lines, block_size) for _, _, lines in groups))
+
+            for domain, rating, lines in groups:
+                domain_seg = self.domain_seg(domain_to_id, domain)
+                # always start new blocks for a new domain and rating.
+                self.examples.add_lines(ids, offsets, lines, block_size, [domain_seg] + prefix, suffix)
+                logger.info("Processed domain %s | rating %s, %i examples", domain, rating, len(self.examples))
+
+            self.examples = self.examples.data
             logger.info("Saving features into cached file %s", cached_features_file)
-            np.save(cached_features_file, self.examples)
+            save_cached_features(cached_features_file, self.examples, compress_cache)
+
+    def keep(self, corpus):
+        """mask of the texts of the parsed `corpus` that go into the dataset."""
+        raise NotImplementedError
+
+    def build_domain_to_id(self, corpus):
+        """the domain -> embedding index map of a training file, None to reuse the saved one."""
+        return None
+
+    def domain_seg(self, domain_to_id, domain):
+        """the embedding index that starts the blocks of `domain`."""
+        raise NotImplementedError
+
+
+class DOIDataset(DomainTagDataset):
+    cache_name = 'doimerged'
+    domain_file = "doi_domain.json"
+    dois = ["Electronics/Computers & Accessories/Laptops", "Restaurants"]
+
+    def keep(self, corpus):
+        return ~corpus.domain_mask(self.dois)
+
+    def build_domain_to_id(self, corpus):
+        domain_to_id = {"[DOI]": 0}
+        for domain in corpus.domains:
+            if domain not in self.dois:
+                domain_to_id[domain] = len(domain_to_id)
+        return domain_to_id
+
+    def domain_seg(self, domain_to_id, domain):
+        if domain in self.dois:
+            return domain_to_id["[DOI]"]
+        return domain_to_id[domain]
 
 
 class LaptopTSDataset(TextDataset):
-    def __init__(self, model_type, masker, tokenizer, file_path='train', block_size=512):
+    def __init__(self, model_type, masker, tokenizer, file_path='train', block_size=512, direct_io=False, compress_cache=False,
+                 tokenize_workers=None):
         assert os.path.isfile(file_path)
         model_type = model_type.split("-")[0]
         directory, filename = os.path.split(file_path)
         cached_features_file = os.path.join(directory, 'cached_doimerged_laptop_' + str(block_size) + '_' + filename + ".npy")
 
-        if os.path.exists(cached_features_file):
+        if has_cached_features(cached_features_file):
             logger.info("Loading features from cached file %s", cached_features_file)
-            self.examples = np.load(cached_features_file)
+            self.examples = load_cached_features(cached_features_file, direct_io)
         else:
             raise Exception
             
 
 class RestTSDataset(TextDataset):
-    def __init__(self, model_type, masker, tokenizer, file_path='train', block_size=512):
+    def __init__(self, model_type, masker, tokenizer, file_path='train', block_size=512, direct_io=False, compress_cache=False,
+                 tokenize_workers=None):
         assert os.path.isfile(file_path)
         model_type = model_type.split("-")[0]
         directory, filename = os.path.split(file_path)
         cached_features_file = os.path.join(directory, 'cached_doimerged_restaurant_' + str(block_size) + '_' + filename + ".npy")
 
-        if os.path.exists(cached_features_file):
+        if has_cached_features(cached_features_file):
             logger.info("Loading features from cached file %s", cached_features_file)
-            self.examples = np.load(cached_features_file)
+            self.examples = load_cached_features(cached_features_file, direct_io)
         else:
             raise Exception
 
 
-class LaptopDomainDataset(TextDataset):
-    def __init__(self, model_type, masker, tokenizer, file_path='train', block_size=512):
-        assert os.path.isfile(file_path)
-        model_type = model_type.split("-")[0]
-        directory, filename = os.path.split(file_path)
-        cached_features_file = os.path.join(directory, 'cached_laptop_' + str(block_size) + '_' + filename + ".npy")
-
-        if os.path.exists(cached_features_file):
-            logger.info("Loading features from cached file %s", cached_features_file)
-            self.examples = np.load(cached_features_file)
-        else:
-            logger.info("Creating features from dataset file at %s", directory)
-
-            dois = ["Electronics/Computers & Accessories/Laptops"]
-
-            logger.info("Domain of Interests (DOIs) %s", str(dois))
-            
-            domain_corpus = defaultdict(lambda: defaultdict(lambda : defaultdict(list)))
-
-            with open(file_path, encoding="utf-8") as f:
-                tag_on = True
-                for line in f:
-                    text = line.strip()
-                    if len(text) == 0:
-                        tag_on = True
-                    elif tag_on:
-                        tag_on = False
-                        segs = text.split()
-                        asin = segs[0]
-                        rating = segs[-1]
-                        domain = "/".join(" ".join(segs[1:-1]).split("/")[:3])
-                    else:
-                        if domain in dois:
-                            domain_corpus[domain][rating][asin].append(text)
-            
-            logger.info("Total number of %d domains", len(domain_corpus))
-            
-            with open(os.path.join(directory, "doi_domain.json")) as f:            
-                domain_to_id = json.load(f)
-
-            block = [-100] * block_size
-            self.examples = []
-
-            for domain in domain_corpus:
-                logger.info("Processing domain %s", domain)
-
-                for rating in domain_corpus[domain]:
-                    logger.info("| rating %s", rating)
-                    # always use a new buffer for a new domain and rating.
-                    buffer = deque()
-                    for asin in domain_corpus[domain][rating]:
-                        for text in domain_corpus[domain][rating][asin]:
-
-                            tokens = tokenizer.tokenize(text)
-                            buffer.extend(tokens)
-
-                            # need to ensure enough text for short and long before making any example.
-                            while len(buffer) >= block_size:
-                                for ix in range(block_size):
-                                    block[ix] = buffer.popleft()
-                                input_ids = tokenizer.convert_tokens_to_ids(block)
-
-                                if domain in dois:
-                                    domain_seg = [domain_to_id["[DOI]"]]
-                                else:
-                                    raise ValueError("domain %s is not in DOI", domain)
-                                    
-                                input_ids = domain_seg + tokenizer.build_inputs_with_special_tokens(input_ids)
-
-                                self.examples.append(np.array([input_ids], dtype = np.uint16))
-                                if len(self.examples) % 5000 == 0:
-                                    logger.info("Processed %i examples", len(self.examples))                
-                                    logger.info("one example is like %s", " ".join(tokenizer.convert_ids_to_tokens(input_ids)))
-                        # clean up the memory.
-                        domain_corpus[domain][rating][asin] = []
-
-            self.examples = np.concatenate(self.examples)
-            logger.info("Saving features into cached file %s", cached_features_file)
-            np.save(cached_features_file, self.examples)
-
+class DOIOnlyDataset(DOIDataset):
+    """
+    Base class of the datasets of only the texts of their `dois`, tagged with the "[DOI]" index of the
+    DOIDataset domain map of the same training file.
+    """
+    cache_name = None
 
-class RestDomainDataset(TextDataset):
-    def __init__(self, model_type, masker, tokenizer, file_path='train', block_size=512):
-        assert os.path.isfile(file_path)
-        model_type = model_type.split("-")[0]
-        directory, filename = os.path.split(file_path)
-        cached_features_file = os.path.join(directory, 'cached_restaurant_' + str(block_size) + '_' + filename + ".npy")
+    def keep(self, corpus):
+        return corpus.domain_mask(self.dois)
 
-        if os.path.exists(cached_features_file):
-            logger.info("Loading features from cached file %s", cached_features_file)
-            self.examples = np.load(cached_features_file)
-        else:
-            logger.info("Creating features from dataset file at %s", directory)
+    def build_domain_to_id(self, corpus):
+        return None
 
-            dois = ["Restaurants"] # ["Electronics/Computers & Accessories/Laptops"]
 
-            logger.info("Domain of Interests (DOIs) %s", str(dois))
-            
-            domain_corpus = defaultdict(lambda: defaultdict(lambda : defaultdict(list)))
-
-            with open(file_path, encoding="utf-8") as f:
-                tag_on = True
-                for line in f:
-                    text = line.strip()
-                    if len(text) == 0:
-                        tag_on = True
-                    elif tag_on:
-                        tag_on = False
-                        segs = text.split()
-                        asin = segs[0]
-                        rating = segs[-1]
-                        domain = "/".join(" ".join(segs[1:-1]).split("/")[:3])
-                    else:
-                        if domain in dois:
-                            domain_corpus[domain][rating][asin].append(text)
-            
-            logger.info("Total number of %d domains", len(domain_corpus))
-            
-            with open(os.path.join(directory, "doi_domain.json")) as f:            
-                domain_to_id = json.load(f)
-
-            block = [-100] * block_size
-            self.examples = []
-
-            for domain in domain_corpus:
-                logger.info("Processing domain %s", domain)
-
-                for rating in domain_corpus[domain]:
-                    logger.info("| rating %s", rating)
-                    # always use a new buffer for a new domain and rating.
-                    buffer = deque()
-                    for asin in domain_corpus[domain][rating]:
-                        for text in domain_corpus[domain][rating][asin]:
-
-                            tokens = tokenizer.tokenize(text)
-                            buffer.extend(tokens)
-
-                            # need to ensure enough text for short and long before making any example.
-                            while len(buffer) >= block_size:
-                                for ix in range(block_size):
-                                    block[ix] = buffer.popleft()
-                                input_ids = tokenizer.convert_tokens_to_ids(block)
-
-                                if domain in dois:
-                                    domain_seg = [domain_to_id["[DOI]"]]
-                                else:
-                                    raise ValueError("domain %s is not in DOI", domain)
-                                    
-                                input_ids = domain_seg + tokenizer.build_inputs_with_special_tokens(input_ids)
-
-                                self.examples.append(np.array([input_ids], dtype = np.uint16))
-                                if len(self.examples) % 5000 == 0:
-                                    logger.info("Processed %i examples", len(self.examples))                
-                                    logger.info("one example is like %s", " ".join(tokenizer.convert_ids_to_tokens(input_ids)))
-                        # clean up the memory.
-                        domain_corpus[domain][rating][asin] = []
-
-            self.examples = np.concatenate(self.examples)
-            logger.info("Saving features into cached file %s", cached_features_file)
-            np.save(cached_features_file, self.examples)
+class LaptopDomainDataset(DOIOnlyDataset):
+    cache_name = 'laptop'
+    dois = ["Electronics/Computers & Accessories/Laptops"]
 
 
-class LRDataset(TextDataset):
-    def __init__(self, model_type, masker, tokenizer, file_path='train', block_size=512):
-        assert os.path.isfile(file_path)
-        model_type = model_type.split("-")[0]
-        directory, filename = os.path.split(file_path)
-        cached_features_file = os.path.join(directory, 'cached_lr_' + str(block_size) + '_' + filename + ".npy")
+class RestDomainDataset(DOIOnlyDataset):
+    cache_name = 'restaurant'
+    dois = ["Restaurants"]
 
-        if os.path.exists(cached_features_file):
-            logger.info("Loading features from cached file %s", cached_features_file)
-            self.examples = np.load(cached_features_file)
-        else:
-            logger.info("Creating features from dataset file at %s", directory)
 
-            dois = ["Electronics/Computers & Accessories/Laptops", "Restaurants"]
+class LRDataset(DOIOnlyDataset):
+    cache_name = 'lr'
+    dois = ["Electronics/Computers & Accessories/Laptops", "Restaurants"]
 
-            logger.info("Domain of Interests (DOIs) %s", str(dois))
-            
-            domain_corpus = defaultdict(lambda: defaultdict(lambda : defaultdict(list)))
-
-            with open(file_path, encoding="utf-8") as f:
-                tag_on = True
-                for line in f:
-                    text = line.strip()
-                    if len(text) == 0:
-                        tag_on = True
-                    elif tag_on:
-                        tag_on = False
-                        segs = text.split()
-                        asin = segs[0]
-                        rating = segs[-1]
-                        domain = "/".join(" ".join(segs[1:-1]).split("/")[:3])
-                    else:
-                        if domain in dois:
-                            domain_corpus[domain][rating][asin].append(text)
-            
-            logger.info("Total number of %d domains", len(domain_corpus))
-            
-            with open(os.path.join(directory, "doi_domain.json")) as f:            
-                domain_to_id = json.load(f)
-
-            block = [-100] * block_size
-            self.examples = []
-
-            for domain in domain_corpus:
-                logger.info("Processing domain %s", domain)
-
-                for rating in domain_corpus[domain]:
-                    logger.info("| rating %s", rating)
-                    # always use a new buffer for a new domain and rating.
-                    buffer = deque()
-                    for asin in domain_corpus[domain][rating]:
-                        for text in domain_corpus[domain][rating][asin]:
-
-                            tokens = tokenizer.tokenize(text)
-                            buffer.extend(tokens)
-
-                            # need to ensure enough text for short and long before making any example.
-                            while len(buffer) >= block_size:
-                                for ix in range(block_size):
-                                    block[ix] = buffer.popleft()
-                                input_ids = tokenizer.convert_tokens_to_ids(block)
-
-                                if domain in dois:
-                                    domain_seg = [domain_to_id["[DOI]"]]
-                                else:
-                                    raise ValueError("domain %s is not in DOI", domain)
-                                    
-                                input_ids = domain_seg + tokenizer.build_inputs_with_special_tokens(input_ids)
-
-                                self.examples.append(np.array([input_ids], dtype = np.uint16))
-                                if len(self.examples) % 5000 == 0:
-                                    logger.info("Processed %i examples", len(self.examples))                
-                                    logger.info("one example is like %s", " ".join(tokenizer.convert_ids_to_tokens(input_ids)))
-                        # clean up the memory.
-                        domain_corpus[domain][rating][asin] = []
-
-            self.examples = np.concatenate(self.examples)
-            logger.info("Saving features into cached file %s", cached_features_file)
-            np.save(cached_features_file, self.examples)
 
-        
-class DiverseTagEmbDataset(TextDataset):
+class DiverseTagEmbDataset(DomainTagDataset):
     """
         This class read the text file with tags and encode a tag with an embedding index.
     """
-    def __init__(self, model_type, masker, tokenizer, file_path='train', block_size=512):
+    cache_name = 'diversetagemb'
+    domain_file = "diverse_domain.json"
+    max_asins = 50  # keep the texts of at most this many asins per domain and rating.
 
-        assert os.path.isfile(file_path)
-        model_type = model_type.split("-")[0]
-        directory, filename = os.path.split(file_path)
-        cached_features_file = os.path.join(directory, 'cached_diversetagemb_' + str(block_size) + '_' + filename + ".npy")
+    def keep(self, corpus):
+        return corpus.asin_cap_mask(self.max_asins)
 
-        if os.path.exists(cached_features_file):
-            logger.info("Loading features from cached file %s", cached_features_file)
-            self.examples = np.load(cached_features_file)
-        else:
-            logger.info("Creating features from dataset file at %s", directory)
-            
-            domain_corpus = defaultdict(lambda: defaultdict(lambda : defaultdict(list)))
-            with open(file_path, encoding="utf-8") as f:
-                tag_on = True
-                for line in f:
-                    text = line.strip()
-                    if len(text) == 0:
-                        tag_on = True
-                    elif tag_on:
-                        tag_on = False
-                        segs = text.split()
-                        asin = segs[0]
-                        rating = segs[-1]
-                        domain = "/".join(" ".join(segs[1:-1]).split("/")[:3])
-                    else:
-                        if len(domain_corpus[domain][rating]) < 50:
-                            domain_corpus[domain][rating][asin].append(text)
-            
-            logger.info("Total number of %d domains", len(domain_corpus))
-            if "train" in file_path:
-                domain_to_id = {"[GENERAL]": 0, "[OTHER]": 1}
-                for ix, domain in enumerate(domain_corpus):
-                    domain_to_id[domain]=len(domain_to_id)
-                with open(os.path.join(directory, "diverse_domain.json"), "w") as fw:            
-                    json.dump(domain_to_id, fw)
-            else:
-                with open(os.path.join(directory, "diverse_domain.json")) as f:            
-                    domain_to_id = json.load(f)
+    def build_domain_to_id(self, corpus):
+        domain_to_id = {"[GENERAL]": 0, "[OTHER]": 1}
+        for domain in corpus.domains:
+            domain_to_id[domain] = len(domain_to_id)
+        return domain_to_id
 
-            block = [-100] * block_size
-            self.examples = []
-
-            for domain in domain_corpus:
-                logger.info("Processing domain %s", domain)
-
-                for rating in domain_corpus[domain]:
-                    logger.info("| rating %s", rating)
-                    # always use a new buffer for a new domain and rating.
-                    buffer = deque()
-                    for asin in domain_corpus[domain][rating]:
-                        for text in domain_corpus[domain][rating][asin]:
-
-                            tokens = tokenizer.tokenize(text)
-                            buffer.extend(tokens)
-
-                            # need to ensure enough text for short and long before making any example.
-                            while len(buffer) >= block_size:
-                                for ix in range(block_size):
-                                    block[ix] = buffer.popleft()
-                                input_ids = tokenizer.convert_tokens_to_ids(block)
-
-                                if domain in domain_to_id:
-                                    domain_seg = [domain_to_id[domain]]
-                                else:
-                                    domain_seg = [domain_to_id["[OTHER]"]]
-                                input_ids = domain_seg + tokenizer.build_inputs_with_special_tokens(input_ids)
-
-                                self.examples.append(np.array([input_ids], dtype = np.uint16))
-                                if len(self.examples) % 5000 == 0:
-                                    logger.info("Processed %i examples", len(self.examples))                
-                                    logger.info("one example is like %s", " ".join(tokenizer.convert_ids_to_tokens(input_ids)))
-                        # clean up the memory.
-                        domain_corpus[domain][rating][asin] = []
-
-            self.examples = np.concatenate(self.examples)
-            logger.info("Saving features into cached file %s", cached_features_file)
-            np.save(cached_features_file, self.examples)
+    def domain_seg(self, domain_to_id, domain):
+        if domain in domain_to_id:
+            return domain_to_id[domain]
+        return domain_to_id["[OTHER]"]
 
-            
-class LRTagEmbDataset(TextDataset):
+
+class LRTagEmbDataset(DiverseTagEmbDataset):
     """
         This class read the text file with tags and encode a tag with an embedding index.
     """
-    def __init__(self, model_type, masker, tokenizer, file_path='train', block_size=512):
-
-        assert os.path.isfile(file_path)
-        model_type = model_type.split("-")[0]
-        directory, filename = os.path.split(file_path)
-        cached_features_file = os.path.join(directory, 'cached_lrtagemb_' + str(block_size) + '_' + filename + ".npy")
-
-        if os.path.exists(cached_features_file):
-            logger.info("Loading features from cached file %s", cached_features_file)
-            self.examples = np.load(cached_features_file)
-        else:
-            logger.info("Creating features from dataset file at %s", directory)
-            
-            domain_corpus = defaultdict(lambda: defaultdict(lambda : defaultdict(list)))
-            with open(file_path, encoding="utf-8") as f:
-                tag_on = True
-                for line in f:
-                    text = line.strip()
-                    if len(text) == 0:
-                        tag_on = True
-                    elif tag_on:
-                        tag_on = False
-                        segs = text.split()
-                        asin = segs[0]
-                        rating = segs[-1]
-                        domain = "/".join(" ".join(segs[1:-1]).split("/")[:3])
-                    else:
-                        if len(domain_corpus[domain][rating]) < 5000:
-                            domain_corpus[domain][rating][asin].append(text)
-            
-            logger.info("Total number of %d domains", len(domain_corpus))
-            if "train" in file_path:
-                domain_to_id = {"[GENERAL]": 0, "[OTHER]": 1}
-                for ix, domain in enumerate(domain_corpus):
-                    domain_to_id[domain]=len(domain_to_id)
-                with open(os.path.join(directory, "diverse_domain.json"), "w") as fw:            
-                    json.dump(domain_to_id, fw)
-            else:
-                with open(os.path.join(directory, "diverse_domain.json")) as f:            
-                    domain_to_id = json.load(f)
-
-            block = [-100] * block_size
-            self.examples = []
-
-            for domain in ["Electronics/Computers & Accessories/Laptops", "Restaurants"]:
-                logger.info("Processing domain %s", domain)
-
-                for rating in domain_corpus[domain]:
-                    logger.info("| rating %s", rating)
-                    # always use a new buffer for a new domain and rating.
-                    buffer = deque()
-                    for asin in domain_corpus[domain][rating]:
-                        for text in domain_corpus[domain][rating][asin]:
-
-                            tokens = tokenizer.tokenize(text)
-                            buffer.extend(tokens)
-
-                            # need to ensure enough text for short and long before making any example.
-                            while len(buffer) >= block_size:
-                                for ix in range(block_size):
-                                    block[ix] = buffer.popleft()
-                                input_ids = tokenizer.convert_tokens_to_ids(block)
-
-                                if domain in domain_to_id:
-                                    domain_seg = [domain_to_id[domain]]
-                                else:
-                                    domain_seg = [domain_to_id["[OTHER]"]]
-                                input_ids = domain_seg + tokenizer.build_inputs_with_special_tokens(input_ids)
-
-                                self.examples.append(np.array([input_ids], dtype = np.uint16))
-                                if len(self.examples) % 5000 == 0:
-                                    logger.info("Processed %i examples", len(self.examples))                
-                                    logger.info("one example is like %s", " ".join(tokenizer.convert_ids_to_tokens(input_ids)))
-                        # clean up the memory.
-                        domain_corpus[domain][rating][asin] = []
-
-            self.examples = np.concatenate(self.examples)
-            logger.info("Saving features into cached file %s", cached_features_file)
-            np.save(cached_features_file, self.examples)
+    cache_name = 'lrtagemb'
+    max_asins = 5000
+    group_domains = ["Electronics/Computers & Accessories/Laptops", "Restaurants"]
 
 
 class SkipTagDataset(TextDataset):
     """
     This class is used for dataset with mixed domains.
+    `corpus` is an optional `read_review_corpus` of `file_path`, its text lines are used instead of parsing the file.
+    It has to be the full corpus, not a `select`ion, since the dataset is every text of the file.
     """
-    def __init__(self, model_type, masker, tokenizer, file_path='train', block_size=512):
+    cache_name = 'skiptag'
+
+    def __init__(self, model_type, masker, tokenizer, file_path='train', block_size=512, direct_io=False, compress_cache=False,
+                 tokenize_workers=None, corpus=None):
         assert os.path.isfile(file_path)
         model_type = model_type.split("-")[0]
-        directory, filename = os.path.split(file_path)
-        cached_features_file = os.path.join(directory, 'cached_skiptag_' + str(block_size) + '_' + filename + ".npy")
+        directory = os.path.dirname(file_path)
+        cached_features_file = cached_features_path(file_path, self.cache_name, block_size)
 
-        if os.path.exists(cached_features_file):
+        if has_cached_features(cached_features_file):
             logger.info("Loading features from cached file %s", cached_features_file)
-            self.examples = np.load(cached_features_file)
+            self.examples = load_cached_features(cached_features_file, direct_io)
         else:
             logger.info("Creating features from dataset file at %s", directory)
 
-            self.examples = []
-            with open(file_path, encoding="utf-8") as f:
-                buffer = []
-                tag_on = True
-                for line in f:
-                    text = line.strip()
-                    if len(text) == 0:
-                        tag_on = True
-                    elif tag_on:
-                        tag_on = False
-                        if len(self.examples) % 5000 == 0:
-                            logger.info("Skip tag %s", text)
-                    else:
-                        tokens = tokenizer.tokenize(text)
-                        buffer.extend(tokens)
-                        while len(buffer) >= block_size:
-                            self.examples.append(
-                                np.array(
-                                    [tokenizer.build_inputs_with_special_tokens(tokenizer.convert_tokens_to_ids(buffer[:block_size]))], 
-                                    dtype = np.uint16))
-                            if len(self.examples) % 5000 == 0:
-                                logger.info("Processed %i examples", len(self.examples))
-                            buffer = buffer[block_size:]
-            self.examples = np.concatenate(self.examples)
+            # the text lines of every review in file order, the tag lines are skipped.
+            if corpus is not None:
+                assert not corpus.selected, "pass the full read_review_corpus of the file, not a selection"
+                lines = np.asarray(corpus.lines)
+            else:
+                lines = np.fromiter((line_no for _, _, _, line_no in parse_amazon_file(file_path)), dtype=np.int64)
+            logger.info("Skipped tags, %i text lines", len(lines))
+
+            ids, offsets = tokenize_file(tokenizer, file_path, model_type, tokenize_workers)
+            prefix, suffix = special_tokens(tokenizer)
+            width = len(prefix) + block_size + len(suffix)
+            self.examples = ExampleMatrix(width, count_blocks(offsets, lines, block_size))
+            self.examples.add_lines(ids, offsets, lines, block_size, prefix, suffix)
+            logger.info("Processed %i examples", len(self.examples))
+
+            self.examples = self.examples.data
             logger.info("Saving features into cached file %s", cached_features_file)
-            np.save(cached_features_file, self.examples)
+            save_cached_features(cached_features_file, self.examples, compress_cache)
 
     
-def load_and_cache_examples(dataset_cls, args, masker, tokenizer, evaluate=False):
-    dataset = dataset_cls(args.model_type, masker, tokenizer, file_path=args.eval_data_file if evaluate else args.train_data_file, block_size=args.block_size)
+def load_and_cache_examples(dataset_cls, args, masker, tokenizer, evaluate=False, corpus=None):
+    # only the datasets read through a ReviewCorpus take one.
+    kwargs = {} if corpus is None else {'corpus': corpus}
+    dataset = dataset_cls(args.model_type, masker, tokenizer, file_path=args.eval_data_file if evaluate else args.train_data_file, block_size=args.block_size,
+                          direct_io=getattr(args, 'direct_io', False), compress_cache=getattr(args, 'compress_cache', False),
+                          tokenize_workers=getattr(args, 'tokenize_workers', None), **kwargs)
     return dataset
+
+
+def load_and_cache_datasets(dataset_clses, args, masker, tokenizer, evaluate=False):
+    """`load_and_cache_examples` of several DomainTagDataset / SkipTagDataset classes over the same file; the file
+    is parsed once for all of them, and not at all if every one is cached already."""
+    file_path = args.eval_data_file if evaluate else args.train_data_file
+    corpus = None
+    datasets = []
+    for dataset_cls in dataset_clses:
+        if corpus is None and not has_cached_features(cached_features_path(file_path, dataset_cls.cache_name, args.block_size)):
+            corpus = read_review_corpus(file_path)
+        datasets.append(load_and_cache_examples(dataset_cls, args, masker, tokenizer, evaluate, corpus))
+    return datasets
@@ -0,0 +1,448 @@
+import os
+import mmap
+import json
+import hashlib
+import numpy as np
+import itertools
+from array import array
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+try:
+    from numba import njit
+except ImportError:  # optional, lines are then gathered into blocks with numpy.
+    njit = None
+try:
+    import blosc2
+except ImportError:  # optional, only needed for compressed feature caches.
+    blosc2 = None
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# number of lines sent to the tokenizer in one batch.
+ENCODE_CHUNK_LINES = 10000
+
+# read buffer for the corpus files, the default of 8 KiB means a read syscall every few reviews.
+READ_BUFFER_SIZE = 1 << 20
+
+
+def tokenizer_vocab(tokenizer):
+    """the token -> id dict of a python tokenizer, added tokens included, or None if its vocabulary is not a
+    dict (e.g. sentencepiece). `get_vocab` only exists from transformers 2.5 on, before that the dict is
+    `vocab` (BERT, DistilBERT) or `encoder` (GPT-2, RoBERTa, openai-gpt)."""
+    if hasattr(tokenizer, "get_vocab"):
+        return tokenizer.get_vocab()
+    for name in ("vocab", "encoder"):
+        vocab = getattr(tokenizer, name, None)
+        if isinstance(vocab, dict):
+            return dict(vocab, **getattr(tokenizer, "added_tokens_encoder", {}))
+    return None
+
+
+class TokenIdLookup(dict):
+    """the vocabulary of a python tokenizer as a plain dict, so a whole chunk of tokens is converted by one
+    `map` over C-level dict lookups instead of a python call per token in `convert_tokens_to_ids`."""
+    def __init__(self, vocab, unk_id):
+        super().__init__(vocab)
+        self.unk_id = unk_id
+
+    def __missing__(self, token):
+        return self.unk_id
+
+    @classmethod
+    def of(cls, tokenizer):
+        """the lookup of `tokenizer`, None for a fast tokenizer or one without a vocabulary dict."""
+        if getattr(tokenizer, "is_fast", False):
+            return None
+        vocab = tokenizer_vocab(tokenizer)
+        return None if vocab is None else cls(vocab, tokenizer.unk_token_id)
+
+
+def encode_lines(tokenizer, lines, lookup=None):
+    """encode a list of lines into a flat array of token ids (without special tokens) and the number of ids
+    of each line. a fast (Rust) tokenizer encodes the whole batch natively, a python tokenizer only
+    tokenizes in python and converts the tokens with `lookup` (see `TokenIdLookup.of`), or without one
+    with a single `convert_tokens_to_ids` call for the whole batch."""
+    if getattr(tokenizer, "is_fast", False):
+        encoded = tokenizer.batch_encode_plus(lines, add_special_tokens=False, return_attention_mask=False, return_token_type_ids=False)["input_ids"]
+        ids = itertools.chain.from_iterable(encoded)
+    else:
+        encoded = [tokenizer.tokenize(line) for line in lines]
+        tokens = itertools.chain.from_iterable(encoded)
+        ids = tokenizer.convert_tokens_to_ids(list(tokens)) if lookup is None else map(lookup.__getitem__, tokens)
+    lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+    return np.fromiter(ids, dtype=np.uint16, count=int(lengths.sum())), lengths
+
+
+_worker_tokenizer = None
+_worker_lookup = None
+
+
+def _init_worker(tokenizer):
+    global _worker_tokenizer, _worker_lookup
+    _worker_tokenizer = tokenizer
+    _worker_lookup = TokenIdLookup.of(tokenizer)
+
+
+def _encode_lines_in_worker(lines):
+    return encode_lines(_worker_tokenizer, lines, _worker_lookup)
+
+
+def _read_chunks(file_path):
+    with open(file_path, "rb", buffering=READ_BUFFER_SIZE) as f:
+        while True:
+            lines = [line.decode("utf-8").strip() for line in itertools.islice(f, ENCODE_CHUNK_LINES)]
+            if len(lines) == 0:
+                return
+            yield lines
+
+
+def available_cpus():
+    """the cores this process may run on (its cpu affinity, e.g. under SLURM or taskset)."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def encode_file(tokenizer, file_path, num_workers=None):
+    """encode every line of a file, yields (ids, lengths) of each chunk of lines in order.
+    a python tokenizer is run over a pool of `num_workers` processes (default: `available_cpus`); a fast
+    tokenizer already encodes a batch on all cores, so it stays in this process."""
+    is_fast = getattr(tokenizer, "is_fast", False)
+    num_workers = num_workers or available_cpus()
+    chunks = _read_chunks(file_path)
+    # a file of a single chunk is not worth starting a pool and pickling the tokenizer to every worker.
+    head = list(itertools.islice(chunks, 2))
+    if is_fast or num_workers == 1 or len(head) < 2:
+        lookup = TokenIdLookup.of(tokenizer)
+        for lines in itertools.chain(head, chunks):
+            yield encode_lines(tokenizer, lines, lookup)
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(tokenizer,)) as executor:
+            # keep a bounded number of chunks in flight instead of reading the whole file up front.
+            pending = deque()
+            for lines in itertools.chain(head, chunks):
+                pending.append(executor.submit(_encode_lines_in_worker, lines))
+                if len(pending) > 2 * num_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+def count_blocks(offsets, lines, block_size):
+    """the number of full blocks of `block_size` ids in the given lines, known before anything is gathered."""
+    return int((offsets[lines + 1] - offsets[lines]).sum()) // block_size
+
+
+class ExampleMatrix(object):
+    """a uint16 matrix of a known number of examples (see `count_blocks`), allocated once and written into
+    group by group, so there are no per-example arrays, no growing and no final concatenate."""
+    def __init__(self, width, n_rows):
+        self.data = np.empty((n_rows, width), dtype=np.uint16)
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def add_lines(self, ids, offsets, lines, block_size, prefix, suffix):
+        """cut the ids of the given line numbers into examples `prefix block suffix` (see `make_examples`) written
+        straight into the next rows; with numba the ids are copied from their lines into the rows without
+        gathering them first."""
+        n_blocks = count_blocks(offsets, lines, block_size)
+        assert self.n + n_blocks <= len(self.data)
+        assert len(prefix) + block_size + len(suffix) == self.data.shape[1]
+        examples = self.data[self.n:self.n + n_blocks]
+        if _copy_lines_to_blocks is None:
+            make_examples(gather_lines(ids, offsets, lines), block_size, prefix, suffix, out=examples)
+        else:
+            _copy_lines_to_blocks(ids, offsets, lines, examples[:, len(prefix):len(prefix) + block_size])
+            frame_examples(examples, prefix, suffix)
+        self.n += n_blocks
+
+
+def load_npy_direct(path, chunk_size=8 << 20):
+    """read a whole .npy file with O_DIRECT into a page-aligned buffer, bypassing the page cache.
+    this is faster than paging in a memory map on a cold cache (e.g. the first epoch on NVMe)."""
+    with open(path, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    size = os.path.getsize(path)
+    # an anonymous map is page-aligned, as O_DIRECT requires for the buffer, offsets and lengths.
+    buf = mmap.mmap(-1, (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE)
+    view = memoryview(buf)
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+    try:
+        pos = 0
+        while pos < size:
+            n = os.preadv(fd, [view[pos:pos + chunk_size]], pos)
+            if n == 0:
+                break
+            pos += n
+    finally:
+        os.close(fd)
+    count = int(np.prod(shape))
+    return np.frombuffer(buf, dtype=dtype, count=count, offset=offset).reshape(shape, order="F" if fortran_order else "C")
+
+
+def _b2nd_file(cached_features_file):
+    return os.path.splitext(cached_features_file)[0] + ".b2nd"
+
+
+def has_cached_features(cached_features_file):
+    """whether the .npy cache or its compressed .b2nd version exists."""
+    if blosc2 is not None and os.path.exists(_b2nd_file(cached_features_file)):
+        return True
+    return os.path.exists(cached_features_file)
+
+
+def save_cached_features(cached_features_file, examples, compress=False):
+    """save to .npy, or with `compress` as a zstd-compressed blosc2 array (.b2nd) next to it."""
+    if not compress:
+        np.save(cached_features_file, examples)
+        return
+    if blosc2 is None:
+        raise ImportError("Please install blosc2 to compress the cached features.")
+    blosc2.asarray(examples, chunks=(4096, examples.shape[1]), urlpath=_b2nd_file(cached_features_file), mode="w",
+                   cparams={"codec": blosc2.Codec.ZSTD, "clevel": 3})
+
+
+def load_cached_features(cached_features_file, direct_io=False):
+    """the cached features, from the .b2nd version if there is one; with `direct_io` a .npy is read with
+    O_DIRECT (see `load_npy_direct`) instead of memory-mapped."""
+    b2nd_file = _b2nd_file(cached_features_file)
+    if blosc2 is not None and os.path.exists(b2nd_file):
+        # decompressed once up front: examples are read in random order, and a single row
+        # would decompress its whole chunk.
+        return blosc2.open(b2nd_file)[:]
+    if direct_io:
+        try:
+            return load_npy_direct(cached_features_file)
+        except (AttributeError, OSError) as e:
+            # no O_DIRECT on this platform or file system.
+            logger.warning("Direct I/O failed (%s), memory-mapping %s instead", e, cached_features_file)
+    # a plain ndarray view of the map, so indexing a row skips np.memmap.__array_finalize__.
+    return np.asarray(np.load(cached_features_file, mmap_mode='r'))
+
+
+def tokenizer_fingerprint(tokenizer):
+    """a short hash of what decides the ids of a line: the tokenizer class, lower casing and the vocabulary
+    (added tokens included), so e.g. cased and uncased tokenizers of one model type get separate id caches."""
+    init_kwargs = getattr(tokenizer, "init_kwargs", {})
+    h = hashlib.sha1(type(tokenizer).__name__.encode("utf-8"))
+    h.update(repr(init_kwargs.get("do_lower_case")).encode("utf-8"))
+    vocab = tokenizer_vocab(tokenizer)
+    if vocab is None:
+        # no vocabulary dict (see `tokenizer_vocab`): the vocabulary files the tokenizer was loaded from.
+        vocab = dict(getattr(tokenizer, "added_tokens_encoder", {}))
+        for name in sorted(getattr(tokenizer, "vocab_files_names", {})):
+            if init_kwargs.get(name) is not None and os.path.isfile(init_kwargs[name]):
+                with open(init_kwargs[name], "rb") as f:
+                    h.update(f.read())
+    h.update(json.dumps(sorted(vocab.items())).encode("utf-8"))
+    return h.hexdigest()[:12]
+
+
+def tokenize_file(tokenizer, file_path, model_type, num_workers=None):
+    """token ids of every (stripped) line of a file: a flat uint16 array of ids and int64 offsets, line i is
+    ids[offsets[i]:offsets[i + 1]]. the result is cached next to the file for each tokenizer (see
+    `tokenizer_fingerprint`) and rebuilt when the file is newer, so all datasets and block sizes built from the
+    same file share one tokenization (see `encode_file` for `num_workers`)."""
+    directory, filename = os.path.split(file_path)
+    prefix = model_type + '_' + tokenizer_fingerprint(tokenizer)
+    ids_file = os.path.join(directory, prefix + '_cached_ids_' + filename + ".npy")
+    offsets_file = os.path.join(directory, prefix + '_cached_offsets_' + filename + ".npy")
+
+    if os.path.exists(offsets_file) and os.path.getmtime(offsets_file) >= os.path.getmtime(file_path):
+        logger.info("Loading token ids from cached file %s", ids_file)
+        return load_cached_features(ids_file), load_cached_features(offsets_file)
+
+    logger.info("Tokenizing lines of %s", file_path)
+    chunks, lengths = [np.empty(0, dtype=np.uint16)], [np.empty(0, dtype=np.int64)]
+    for chunk_ids, chunk_lengths in encode_file(tokenizer, file_path, num_workers):
+        chunks.append(chunk_ids)
+        lengths.append(chunk_lengths)
+        logger.info("Tokenized %i lines", sum(len(chunk_lengths) for chunk_lengths in lengths))
+    ids = np.concatenate(chunks)
+    lengths = np.concatenate(lengths)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    logger.info("Saving token ids into cached file %s", ids_file)
+    np.save(ids_file, ids)
+    # saved last, so its mtime marks a complete cache.
+    np.save(offsets_file, offsets)
+    return ids, offsets
+
+
+def gather_lines(ids, offsets, lines):
+    """the ids of the given line numbers, concatenated in order."""
+    starts = offsets[lines]
+    lengths = offsets[lines + 1] - starts
+    ends = np.cumsum(lengths)
+    # each id is at the start of its line plus its position within the line.
+    return ids[np.repeat(starts - (ends - lengths), lengths) + np.arange(ends[-1] if len(ends) > 0 else 0)]
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _copy_lines_to_blocks(ids, offsets, lines, blocks):
+        """fill `blocks` row by row with the ids of the given lines, the ids left at the end are dropped."""
+        n_blocks, block_size = blocks.shape
+        row, col = 0, 0
+        for line in lines:
+            for i in range(offsets[line], offsets[line + 1]):
+                if row == n_blocks:
+                    return
+                blocks[row, col] = ids[i]
+                col += 1
+                if col == block_size:
+                    row += 1
+                    col = 0
+else:
+    _copy_lines_to_blocks = None
+
+
+def special_tokens(tokenizer):
+    """the ids `tokenizer.build_inputs_with_special_tokens` puts before and after a block, e.g. ([CLS], [SEP])
+    for BERT and ([], []) for GPT-2. they are the same for every block, so they are found once from a block of
+    a single sentinel id instead of calling the tokenizer per block."""
+    sentinel = -1  # not an id of any vocabulary.
+    ids = list(tokenizer.build_inputs_with_special_tokens([sentinel]))
+    i = ids.index(sentinel)
+    return ids[:i], ids[i + 1:]
+
+
+def make_examples(ids, block_size, prefix, suffix, out=None):
+    """cut ids into blocks of `block_size` as rows `prefix block suffix` (e.g. `[domain_seg] [CLS] block [SEP]`),
+    the ids left at the end are dropped. the rows are written into `out` if given."""
+    n_blocks = len(ids) // block_size
+    # one allocation for the final rows, the blocks are copied straight into their columns.
+    examples = np.empty((n_blocks, len(prefix) + block_size + len(suffix)), dtype=np.uint16) if out is None else out
+    blocks = np.asarray(ids[:n_blocks * block_size]).reshape(n_blocks, block_size)
+    examples[:, len(prefix):len(prefix) + block_size] = blocks
+    return frame_examples(examples, prefix, suffix)
+
+
+def frame_examples(examples, prefix, suffix):
+    """write the `prefix` and `suffix` columns around the blocks already in `examples`."""
+    # they are the same for every row, so each of them goes in with one broadcast.
+    examples[:, :len(prefix)] = np.array(prefix, dtype=np.uint16)
+    examples[:, examples.shape[1] - len(suffix):] = np.array(suffix, dtype=np.uint16)
+    return examples
+
+
+def parse_amazon_file(file_path):
+    """iterate over a review file with tags, yields (domain, rating, asin, line number) for each text line.
+    a review is a header line `asin category rating` followed by its text lines and an empty line;
+    the domain is the first 3 levels of the category."""
+    domains = {}  # raw category -> interned domain, so each distinct category is normalized once.
+    with open(file_path, "rb", buffering=READ_BUFFER_SIZE) as f:
+        tag_on = True
+        for line_no, line in enumerate(f):
+            text = line.decode("utf-8").strip()
+            if len(text) == 0:
+                tag_on = True
+            elif tag_on:
+                tag_on = False
+                # the first and last whitespace-separated fields, the category is everything in between.
+                segs = text.split(None, 1)
+                asin = segs[0]
+                if len(segs) == 2:
+                    segs = segs[1].rsplit(None, 1)
+                rating = segs[-1]
+                category = segs[0] if len(segs) == 2 else ""
+                domain = domains.get(category)
+                if domain is None:
+                    domain = domains[category] = "/".join(" ".join(category.split()).split("/")[:3])
+            else:
+                yield domain, rating, asin, line_no
+
+
+class ReviewCorpus(object):
+    """the text lines of a tagged review file as a struct of arrays: line numbers with parallel
+    domain / rating / asin ids, instead of nested dicts of small per-asin lists."""
+    def __init__(self):
+        self.lines = array('l')
+        self.domain_ids = array('i')
+        self.rating_ids = array('i')
+        self.asin_ids = array('i')
+        self.domains = {}  # domain -> id, in first-seen order.
+        self.ratings = {}  # (domain id, rating) -> id, in first-seen order.
+        self.asins = {}  # (rating id, asin) -> id, in first-seen order.
+        self.selected = False  # True for the texts picked by `select`, not every text of the file.
+
+    def append(self, domain, rating, asin, line_no):
+        domain_id = self.domains.setdefault(domain, len(self.domains))
+        rating_id = self.ratings.setdefault((domain_id, rating), len(self.ratings))
+        asin_id = self.asins.setdefault((rating_id, asin), len(self.asins))
+        self.lines.append(line_no)
+        self.domain_ids.append(domain_id)
+        self.rating_ids.append(rating_id)
+        self.asin_ids.append(asin_id)
+
+    def domain_mask(self, domains):
+        """mask of the texts of the given domains."""
+        return np.isin(np.asarray(self.domain_ids), [self.domains[domain] for domain in domains if domain in self.domains])
+
+    def asin_cap_mask(self, max_asins):
+        """mask of the texts that are read before a rating of a domain has `max_asins` asins, i.e. the texts up to
+        the first text of its `max_asins`-th asin."""
+        rating_ids = np.asarray(self.rating_ids)
+        # asin ids are given in first-seen order, so this is the first text of each asin.
+        _, first = np.unique(np.asarray(self.asin_ids), return_index=True)
+        asin_ratings = rating_ids[first]
+        # rank of each asin within its rating, in first-seen order.
+        order = np.argsort(asin_ratings, kind="stable")
+        sorted_ratings = asin_ratings[order]
+        ranks = np.empty_like(order)
+        ranks[order] = np.arange(len(order)) - np.searchsorted(sorted_ratings, sorted_ratings)
+        cutoffs = np.full(len(self.ratings), len(rating_ids), dtype=np.int64)
+        capped = ranks == max_asins - 1
+        cutoffs[asin_ratings[capped]] = first[capped]
+        return np.arange(len(rating_ids)) <= cutoffs[rating_ids]
+
+    def select(self, mask):
+        """the texts where `mask` is set as a new corpus that keeps the ids of this one, for `groups`."""
+        corpus = ReviewCorpus()
+        corpus.lines, corpus.domain_ids, corpus.rating_ids, corpus.asin_ids = (
+            np.asarray(column)[mask] for column in (self.lines, self.domain_ids, self.rating_ids, self.asin_ids))
+        domain_ids = set(np.unique(corpus.domain_ids).tolist())
+        corpus.domains = {domain: domain_id for domain, domain_id in self.domains.items() if domain_id in domain_ids}
+        corpus.ratings = self.ratings
+        corpus.asins = self.asins
+        corpus.selected = True
+        return corpus
+
+    def groups(self, domains=None):
+        """yields (domain, rating, line numbers) for each rating of a domain in first-seen order (domains in the
+        order of `domains` if given), lines of the same asin are kept together as in the file."""
+        if len(self.lines) == 0:
+            return
+        lines = np.asarray(self.lines)
+        rating_ids = np.asarray(self.rating_ids)
+        order = np.lexsort((np.asarray(self.asin_ids), rating_ids, np.asarray(self.domain_ids)))
+        sorted_rating_ids = rating_ids[order]
+        bounds = np.flatnonzero(sorted_rating_ids[1:] != sorted_rating_ids[:-1]) + 1
+        rating_keys = list(self.ratings)
+        domain_groups = defaultdict(list)
+        for start, end in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [len(order)]])):
+            domain_id, rating = rating_keys[sorted_rating_ids[start]]
+            domain_groups[domain_id].append((rating, order[start:end]))
+        for domain in (self.domains if domains is None else domains):
+            for rating, idxs in domain_groups.get(self.domains.get(domain), []):
+                yield domain, rating, lines[idxs]
+
+
+def read_review_corpus(file_path):
+    """the ReviewCorpus of every text of a review file. datasets built from the same file can share it
+    (their `corpus` argument), so the file is parsed once and each of them only `select`s its texts."""
+    corpus = ReviewCorpus()
+    for domain, rating, asin, line_no in parse_amazon_file(file_path):
+        corpus.append(domain, rating, asin, line_no)
+    return corpus
@@ -5,7 +5,8 @@ import torch
 from torch.utils.data import Dataset
 from tqdm import tqdm
 import random
-from collections import defaultdict, deque
+from .data import (ExampleMatrix, count_blocks, has_cached_features, load_cached_features, make_examples,
+                   read_review_corpus, save_cached_features, special_tokens, tokenize_file)
 
 import logging
 
@@ -21,80 +22,55 @@ def set_seed(args):
 
 
 class TextDataset(Dataset):
-    def __init__(self, model_type, tokenizer, file_path='train', block_size=512):
+    def __init__(self, model_type, tokenizer, file_path='train', block_size=512, direct_io=False, compress_cache=False,
+                 tokenize_workers=None):
         assert os.path.isfile(file_path)
         model_type = model_type.split("-")[0]
         directory, filename = os.path.split(file_path)
         cached_features_file = os.path.join(directory, 'cached_lm_' + str(block_size) + '_' + filename + ".npy")
 
-        if os.path.exists(cached_features_file):
+        if has_cached_features(cached_features_file):
             logger.info("Loading features from cached file %s", cached_features_file)
-            self.examples = np.load(cached_features_file)
+            self.examples = load_cached_features(cached_features_file, direct_io)
         else:
             logger.info("Creating features from dataset file at %s", directory)
 
-            self.examples = []
-            with open(file_path, encoding="utf-8") as f:
-                buffer = []
-                for line in f:
-                    text = line.strip()
-                    if len(text) > 0:
-                        tokens = tokenizer.tokenize(text)
-                        buffer.extend(tokens)
-                        while len(buffer) >= block_size:
-                            self.examples.append(
-                                np.array(
-                                    [tokenizer.build_inputs_with_special_tokens(tokenizer.convert_tokens_to_ids(buffer[:block_size]))], 
-                                    dtype = np.uint16))
-                            if len(self.examples) % 5000 == 0:
-                                logger.info("Processed %i examples", len(self.examples))
-                            buffer = buffer[block_size:]
-                        
-            self.examples = np.concatenate(self.examples)
-            
+            ids, _ = tokenize_file(tokenizer, file_path, model_type, tokenize_workers)
+            self.examples = make_examples(ids, block_size, *special_tokens(tokenizer))
+            logger.info("Processed %i examples", len(self.examples))
+
             logger.info("Saving features into cached file %s", cached_features_file)
-            np.save(cached_features_file, self.examples)
-        
+            save_cached_features(cached_features_file, self.examples, compress_cache)
+
     def __len__(self):
         return len(self.examples)
 
     def __getitem__(self, item):
+        # widen the uint16 row once into an int64 buffer that torch shares without a copy;
+        # maskers build labels from the inputs, so they have to be long already.
         return torch.from_numpy(self.examples[item].astype(np.int64))
 
             
 class XDDataset(TextDataset):
-    def __init__(self, model_type, tokenizer, file_path='train', block_size=512):
+    def __init__(self, model_type, tokenizer, file_path='train', block_size=512, direct_io=False, compress_cache=False,
+                 tokenize_workers=None):
         assert os.path.isfile(file_path)
         model_type = model_type.split("-")[0]
         directory, filename = os.path.split(file_path)
         cached_features_file = os.path.join(directory, 'cached_xd_' + str(block_size) + '_' + filename + ".npy")
 
-        if os.path.exists(cached_features_file):
+        if has_cached_features(cached_features_file):
             logger.info("Loading features from cached file %s", cached_features_file)
-            self.examples = np.load(cached_features_file)
+            self.examples = load_cached_features(cached_features_file, direct_io)
         else:
-            domain_corpus = defaultdict(lambda: defaultdict(lambda : defaultdict(list)))
-            with open(file_path, encoding="utf-8") as f:
-                tag_on = True
-                for line in f:
-                    text = line.strip()
-                    if len(text) == 0:
-                        tag_on = True
-                    elif tag_on:
-                        tag_on = False
-                        segs = text.split()
-                        asin = segs[0]
-                        rating = segs[-1]
-                        domain = "/".join(" ".join(segs[1:-1]).split("/")[:3])
-                    else:
-                        domain_corpus[domain][rating][asin].append(text)
-
-            logger.info("Total number of %d domains", len(domain_corpus))          
+            corpus = read_review_corpus(file_path)
+
+            logger.info("Total number of %d domains", len(corpus.domains))          
             
             dois = ["Electronics/Computers & Accessories/Laptops", "Restaurants"]
             if "train" in file_path:
                 domain_to_id = {"[GENERAL]": 0}
-                for ix, domain in enumerate(domain_corpus):
+                for ix, domain in enumerate(corpus.domains):
                     if domain not in dois:
                         domain_to_id[domain]=len(domain_to_id)
                 domain_to_id["Electronics/Computers & Accessories/Laptops"] = len(domain_to_id)
@@ -105,39 +81,22 @@ class XDDataset(TextDataset):
                 with open(os.path.join(directory, "domain.json")) as f:            
                     domain_to_id = json.load(f)
 
-            self.examples = []
-
-            for domain in domain_corpus:
-                logger.info("Processing domain %s", domain)
-
-                for rating in domain_corpus[domain]:
-                    logger.info("| rating %s", rating)
-                    # always use a new buffer for a new domain and rating.
-                    buffer = deque()
-                    block = [-100] * block_size
-                    for asin in domain_corpus[domain][rating]:
-                        for text in domain_corpus[domain][rating][asin]:
-                            tokens = tokenizer.tokenize(text)
-                            buffer.extend(tokens)
-
-                            while len(buffer) >= block_size:
-                                for ix in range(block_size):
-                                    block[ix] = buffer.popleft()
-                                input_ids = tokenizer.convert_tokens_to_ids(block)
-
-                                domain_seg = [domain_to_id[domain]]
-                                input_ids = domain_seg + tokenizer.build_inputs_with_special_tokens(input_ids)
-
-                                self.examples.append(np.array([input_ids], dtype = np.uint16))
-                                if len(self.examples) % 5000 == 0:
-                                    logger.info("Processed %i examples", len(self.examples))                
-                                    logger.info("one example is like %s", " ".join(tokenizer.convert_ids_to_tokens(input_ids)))
-                        # clean up the memory.
-                        domain_corpus[domain][rating][asin] = []
-                    
-            self.examples = np.concatenate(self.examples)
+            ids, offsets = tokenize_file(tokenizer, file_path, model_type, tokenize_workers)
+            prefix, suffix = special_tokens(tokenizer)
+            groups = list(corpus.groups())
+            # every row starts with its domain seg ahead of the tokenizer's prefix.
+            width = 1 + len(prefix) + block_size + len(suffix)
+            self.examples = ExampleMatrix(width, sum(count_blocks(offsets, lines, block_size) for _, _, lines in groups))
+
+            for domain, rating, lines in groups:
+                domain_seg = domain_to_id[domain]
+                # always start new blocks for a new domain and rating.
+                self.examples.add_lines(ids, offsets, lines, block_size, [domain_seg] + prefix, suffix)
+                logger.info("Processed domain %s | rating %s, %i examples", domain, rating, len(self.examples))
+
+            self.examples = self.examples.data
             logger.info("Saving features into cached file.")
-            np.save(cached_features_file, self.examples)
+            save_cached_features(cached_features_file, self.examples, compress_cache)
 
 def load_and_cache_examples(dataset_cls, args, tokenizer, evaluate=False):
     if evaluate:
@@ -145,5 +104,7 @@ def load_and_cache_examples(dataset_cls, args, tokenizer, evaluate=False):
     else:
         file_path = args.train_data_file
     print(file_path)
-    dataset = dataset_cls(args.model_type, tokenizer, file_path=file_path, block_size=args.block_size)
+    dataset = dataset_cls(args.model_type, tokenizer, file_path=file_path, block_size=args.block_size,
+                          direct_io=args.direct_io, compress_cache=args.compress_cache,
+                          tokenize_workers=args.tokenize_workers)
     return dataset
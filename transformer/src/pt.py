@@ -149,6 +149,12 @@ def main():
                         help="Overwrite the content of the output directory")
     parser.add_argument('--overwrite_cache', action='store_true',
                         help="Overwrite the cached training and evaluation sets")
+    parser.add_argument('--direct_io', action='store_true',
+                        help="Read cached training and evaluation sets with O_DIRECT instead of memory-mapping them")
+    parser.add_argument('--compress_cache', action='store_true',
+                        help="Save cached training and evaluation sets compressed with blosc2 (.b2nd) instead of .npy")
+    parser.add_argument('--tokenize_workers', type=int, default=None,
+                        help="Number of processes that tokenize the corpus with a python tokenizer (default: the cores this process may use)")
     parser.add_argument('--seed', type=int, default=42,
                         help="random seed for initialization")
 